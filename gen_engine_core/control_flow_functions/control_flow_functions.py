@@ -1,5 +1,7 @@
 import os
 import asyncio
+import hashlib
+import json
 import re
 import uuid
 import yaml
@@ -20,6 +22,19 @@ BASE_URL_A = obj_conf["API"]["BASE_URL_A"]
 BASE_URL_B = obj_conf["API"]["BASE_URL_B"]
 MODE = obj_conf["SYSTEM"]["MODE"]
 CONCURRENCY_LIMIT = obj_conf["SYSTEM"]["CONCURRENCY_LIMIT"]
+DOUBLE_CHECK_COUNT = obj_conf["SYSTEM"]["DOUBLE_CHECK_COUNT"]
+REQUIREMENTS = obj_conf["REQUIREMENTS"]
+JUDGE_CONF = obj_conf.get("JUDGE", {})
+JUDGE_ENABLED = JUDGE_CONF.get("ENABLED", False)
+JUDGE_BATCH_SIZE = JUDGE_CONF.get("BATCH_SIZE", 5)
+JUDGE_CONCURRENCY_LIMIT = JUDGE_CONF.get("CONCURRENCY_LIMIT", 10)
+JUDGE_MAX_BATCH_WAIT = JUDGE_CONF.get("MAX_BATCH_WAIT", 30)
+JUDGE_MIN_TURNS = JUDGE_CONF.get("MIN_TURNS", 4)
+JUDGE_MIN_CHARS = JUDGE_CONF.get("MIN_CHARS", 200)
+JUDGE_MAX_CHARS = JUDGE_CONF.get("MAX_CHARS", 30000)
+JUDGE_MAX_REPETITION = JUDGE_CONF.get("MAX_REPETITION", 0.3)
+JUDGE_BLOCKLIST = JUDGE_CONF.get("BLOCKLIST", [])
+JUDGE_CACHE_FILE = JUDGE_CONF.get("CACHE_FILE", "judge_cache.jsonl")
 
 engine_wrapper = EngineWrapper(
     model=LOGICAL_MODEL_A,
@@ -95,4 +110,220 @@ def parse_conversation_to_sharegpt_format(conversation):
 
 def parse_convo_messages(convo):
     print("==================================")
-    return (convo, False)
\ No newline at end of file
+    return (convo, False)
+
+
+def repetition_ratio(conversation):
+    # Fraction of word trigrams in the 'gpt' turns that have already appeared earlier
+    words = " ".join(
+        turn["value"] for turn in conversation if turn["from"] == "gpt"
+    ).lower().split()
+    trigrams = [tuple(words[i : i + 3]) for i in range(len(words) - 2)]
+    if not trigrams:
+        return 0.0
+    return 1 - len(set(trigrams)) / len(trigrams)
+
+
+def passes_local_filters(conversation):
+    # Cheap checks that run before anything is sent to the large model
+    if len(conversation) < JUDGE_MIN_TURNS:
+        print(f"Conversation has fewer than {JUDGE_MIN_TURNS} turns. Rejecting.")
+        return False
+
+    total_chars = sum(len(turn["value"]) for turn in conversation)
+    if total_chars < JUDGE_MIN_CHARS or total_chars > JUDGE_MAX_CHARS:
+        print(f"Conversation length ({total_chars} chars) is out of bounds. Rejecting.")
+        return False
+
+    values = [turn["value"].strip() for turn in conversation]
+    if len(set(values)) < len(values):
+        print("Conversation contains duplicated turns. Rejecting.")
+        return False
+
+    if repetition_ratio(conversation) > JUDGE_MAX_REPETITION:
+        print("Conversation is too repetitive. Rejecting.")
+        return False
+
+    blocklist = [phrase.lower() for phrase in JUDGE_BLOCKLIST]
+    if any(phrase in value.lower() for value in values for phrase in blocklist):
+        print("Conversation contains blocklisted phrases. Rejecting.")
+        return False
+
+    return True
+
+
+# Caps model B requests in flight, however many judge batches are running
+judge_semaphore = asyncio.Semaphore(JUDGE_CONCURRENCY_LIMIT)
+
+judge_step = GenerationStep(
+    prompt_path="judge_conversations.yaml",
+    sampling_params={
+        "max_tokens": 20 * JUDGE_BATCH_SIZE + 50,
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "stop": None,
+    },
+    completion_mode=False,
+    retries=1,
+    engine_wrapper=engine_wrapper_large,
+    return_input_too=False,
+    parse_sharegpt=False,
+    semaphore=judge_semaphore,
+)
+
+
+def judge_prompt_arguments(conversations):
+    guidelines = "\n".join(
+        f"- {line}" for line in REQUIREMENTS["GUIDELINES"] + REQUIREMENTS["AVOID"]
+    )
+    conversations_str = "\n\n".join(
+        f"Conversation {i + 1}:\n"
+        + "\n".join(f"{turn['from']}: {turn['value']}" for turn in conversation)
+        for i, conversation in enumerate(conversations)
+    )
+    return {"guidelines": guidelines, "conversations": conversations_str}
+
+
+def parse_judge_verdicts(response, count):
+    verdicts = {}
+    for number, verdict in re.findall(
+        r"Conversation\s*(\d+)\s*:\s*(PASS|FAIL)", response, re.IGNORECASE
+    ):
+        index = int(number) - 1
+        if 0 <= index < count and index not in verdicts:
+            verdicts[index] = verdict.upper() == "PASS"
+    return verdicts
+
+
+def conversation_cache_key(conversation):
+    # Only what is actually sent to model B goes into the key
+    return hashlib.sha256(
+        json.dumps(
+            [
+                LOGICAL_MODEL_B,
+                REQUIREMENTS["GUIDELINES"],
+                REQUIREMENTS["AVOID"],
+                judge_step.load_prompt(),
+                conversation,
+            ]
+        ).encode()
+    ).hexdigest()
+
+
+judge_cache = None
+
+
+def load_judge_cache():
+    global judge_cache
+    if judge_cache is None:
+        judge_cache = {}
+        cache_path = os.path.join(OUTPUT_FOLDER, JUDGE_CACHE_FILE)
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as file:
+                for line_number, line in enumerate(file, 1):
+                    try:
+                        entry = json.loads(line)
+                        judge_cache[entry["key"]] = entry["passed"]
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        print(
+                            f"WARNING: skipping unreadable line {line_number} in {cache_path}."
+                        )
+    return judge_cache
+
+
+def save_judge_verdict(key, passed):
+    load_judge_cache()[key] = passed
+    if not os.path.exists(OUTPUT_FOLDER):
+        os.makedirs(OUTPUT_FOLDER)
+    with open(os.path.join(OUTPUT_FOLDER, JUDGE_CACHE_FILE), "a") as file:
+        file.write(json.dumps({"key": key, "passed": passed}) + "\n")
+
+
+async def judge_batch(conversations):
+    # Polls model B up to DOUBLE_CHECK_COUNT times (at least once), only
+    # re-asking about conversations that have not reached a majority yet.
+    # Conversations still undecided after every round are settled by the votes
+    # they did get, with split votes counted as FAIL. Returns the True/False
+    # verdicts (None only if no round produced a vote for that conversation)
+    # and the number of split votes
+    rounds = max(DOUBLE_CHECK_COUNT, 1)
+    majority = rounds // 2 + 1
+    passes = [0] * len(conversations)
+    fails = [0] * len(conversations)
+    undecided = list(range(len(conversations)))
+
+    for _ in range(rounds):
+        if not undecided:
+            break
+        arguments = judge_prompt_arguments([conversations[i] for i in undecided])
+        try:
+            response = await judge_step.generate(arguments)
+        except Exception as e:
+            print(f"Judge call failed: {e}")
+            continue
+
+        verdicts = parse_judge_verdicts(response, len(undecided))
+        for position, index in enumerate(undecided):
+            if position not in verdicts:
+                continue
+            if verdicts[position]:
+                passes[index] += 1
+            else:
+                fails[index] += 1
+        undecided = [
+            i for i in undecided if passes[i] < majority and fails[i] < majority
+        ]
+
+    results = []
+    ties = 0
+    for i in range(len(conversations)):
+        if passes[i] + fails[i] == 0:
+            results.append(None)
+            continue
+        if passes[i] == fails[i]:
+            ties += 1
+        passed = passes[i] > fails[i]
+        save_judge_verdict(conversation_cache_key(conversations[i]), passed)
+        results.append(passed)
+    return results, ties
+
+
+async def judge_conversations(conversations):
+    """Returns one verdict per conversation: True/False, or None if model B
+    could not give one. Local filters run first, cached verdicts are reused,
+    and only the remaining conversations are sent to model B in batches of
+    JUDGE_BATCH_SIZE."""
+    cache = load_judge_cache()
+    results = [False] * len(conversations)
+    to_judge = []
+    for i, conversation in enumerate(conversations):
+        if not passes_local_filters(conversation):
+            continue
+        key = conversation_cache_key(conversation)
+        if key in cache:
+            results[i] = cache[key]
+        else:
+            to_judge.append(i)
+
+    batches = [
+        to_judge[i : i + JUDGE_BATCH_SIZE]
+        for i in range(0, len(to_judge), JUDGE_BATCH_SIZE)
+    ]
+    batch_results = await asyncio.gather(
+        *[judge_batch([conversations[i] for i in batch]) for batch in batches]
+    )
+    ties = 0
+    for batch, (verdicts, batch_ties) in zip(batches, batch_results):
+        ties += batch_ties
+        for i, passed in zip(batch, verdicts):
+            results[i] = passed
+
+    unresolved = results.count(None)
+    print(
+        f"Judged {len(conversations)} conversations: {len(to_judge)} sent to model B, {results.count(True)} accepted, {results.count(False)} rejected ({ties} on a split vote), {unresolved} unresolved."
+    )
+    if unresolved:
+        print(
+            f"WARNING: model B did not return a usable verdict for {unresolved} conversations (judge call failed or reply could not be parsed)."
+        )
+    return results
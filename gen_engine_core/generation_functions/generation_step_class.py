@@ -1,3 +1,4 @@
+import asyncio
 import re
 import random
 import os
@@ -22,18 +23,22 @@ class GenerationStep:
         },
         completion_mode=True,  # Chat vs completion mode
         retries=0,
+        retry_backoff=1,  # seconds to wait before the first retry; doubles on every retry after that
         engine_wrapper=None,
         logging_level=logging.INFO,  # Default logging level
         output_processor=lambda x: x,  # to ensure that control flow does not need to have decision code handling the outputs of the LLM, you can pass in a function to handle and modify the outputs (post regex) here. By default it's just the identity function and does nothing.
         return_input_too=True,
         default_prompt_folder="prompts",
         prompt_folder="prompts",
+        parse_sharegpt=True,  # in chat mode, turn "Human:"/"AI:" lines into ShareGPT turns; if False the regex is applied to the raw response instead, like in completion mode
+        semaphore=None,  # optional asyncio.Semaphore held only while a request is in flight, not while waiting to retry; share one between steps that call the same model
     ):
         self.prompt_path = prompt_path
         self.regex = regex
         self.sampling_params = sampling_params
         self.completion_mode = completion_mode
         self.retries = retries
+        self.retry_backoff = retry_backoff
         self.logging_level = logging_level
         self.output_processor = output_processor
         self.return_input_too = return_input_too
@@ -42,11 +47,18 @@ class GenerationStep:
         self.engine_wrapper = engine_wrapper
         self.prompt_folder = prompt_folder
         self.default_prompt_folder = default_prompt_folder
+        self.parse_sharegpt = parse_sharegpt
+        self.semaphore = semaphore
+        self.prompt = None
         logging.basicConfig(
             level=self.logging_level, format="%(asctime)s - %(levelname)s - %(message)s"
         )
 
-    async def generate(self, arguments={}):
+    def load_prompt(self):
+        # The prompt file is only read once per step, not on every generate() call
+        if self.prompt is not None:
+            return self.prompt
+
         # Current file directory
         current_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -62,7 +74,28 @@ class GenerationStep:
             )
 
         with open(full_prompt_path, "r") as pf:
-            prompt = pf.read()
+            self.prompt = pf.read()
+        return self.prompt
+
+    def extract(self, response):
+        match = re.search(self.regex, response)
+        if match.groups():
+            return match.group(1)
+        return match.group(0)
+
+    async def backoff(self, times_tried):
+        if times_tried <= self.retries:
+            delay = self.retry_backoff * 2 ** (times_tried - 1)
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+    async def submit(self, submit_function, *args):
+        if self.semaphore is None:
+            return await submit_function(*args)
+        async with self.semaphore:
+            return await submit_function(*args)
+
+    async def generate(self, arguments={}):
+        prompt = self.load_prompt()
 
         # Submit generation and return response, retrying as needed
         times_tried = 0
@@ -70,10 +103,12 @@ class GenerationStep:
             prompt_formatted = safe_format(prompt, **arguments)
             while times_tried <= self.retries:
                 try:
-                    response, timeout = await self.engine_wrapper.submit_completion(
-                        prompt_formatted, self.sampling_params
+                    response, timeout = await self.submit(
+                        self.engine_wrapper.submit_completion,
+                        prompt_formatted,
+                        self.sampling_params,
                     )
-                    filtered_response = re.search(self.regex, response).group(1)
+                    filtered_response = self.extract(response)
                     ret = self.output_processor(filtered_response)
                     if self.return_input_too:
                         return ret, prompt_formatted + filtered_response
@@ -82,6 +117,7 @@ class GenerationStep:
                     logging.error(f"Error in Generation Step: {e}")
                     traceback.print_exc()
                     times_tried += 1
+                    await self.backoff(times_tried)
             raise Exception("Generation step failed -- too many retries!")
         else:
             messages = yaml.safe_load(prompt)
@@ -110,23 +146,26 @@ class GenerationStep:
                         }
                         for message in messages
                     ]
-                    response, timeout = await self.engine_wrapper.submit_chat(
-                        messages, self.sampling_params
+                    response, timeout = await self.submit(
+                        self.engine_wrapper.submit_chat, messages, self.sampling_params
                     )
 
-                    # Modify the parsing logic here
-                    # Split the response by newlines and create a list of dictionaries
-                    conversation_sharegpt = []
-                    lines = response.split("\n")
-                    for line in lines:
-                        if line.startswith("Human:") or line.startswith("AI:"):
-                            speaker, message = line.split(":", 1)
-                            conversation_sharegpt.append({
-                                "from": speaker.strip(),
-                                "value": message.strip()
-                            })
+                    if self.parse_sharegpt:
+                        # Modify the parsing logic here
+                        # Split the response by newlines and create a list of dictionaries
+                        conversation_sharegpt = []
+                        lines = response.split("\n")
+                        for line in lines:
+                            if line.startswith("Human:") or line.startswith("AI:"):
+                                speaker, message = line.split(":", 1)
+                                conversation_sharegpt.append({
+                                    "from": speaker.strip(),
+                                    "value": message.strip()
+                                })
 
-                    ret = self.output_processor(conversation_sharegpt)
+                        ret = self.output_processor(conversation_sharegpt)
+                    else:
+                        ret = self.output_processor(self.extract(response))
                     if self.return_input_too:
                         return ret, yaml.dump(
                             messages
@@ -144,4 +183,5 @@ class GenerationStep:
                     logging.error(f"Error in Generation Step: {e}")
                     traceback.print_exc()
                     times_tried += 1
+                    await self.backoff(times_tried)
             raise Exception("Generation step failed -- too many retries!")
\ No newline at end of file
@@ -0,0 +1,206 @@
+import asyncio
+import time
+import traceback
+
+_DONE = object()  # sent downstream once a stage has nothing left to emit
+
+
+class PipelineStage:
+    def __init__(
+        self,
+        name,
+        function,  # async function taking one item and returning the item for the next stage, or None to drop it
+        concurrency=1,
+        queue_size=None,  # bounded input queue, so fast stages wait on slow ones instead of piling up items. Defaults to twice the concurrency
+        batch_size=None,  # if set, the function gets a list of up to batch_size items and must return a list with one output (or None) per input
+        batch_wait=None,  # seconds a partial batch waits for more items before it is sent anyway. None waits until the batch is full or the input runs out
+    ):
+        self.name = name
+        self.function = function
+        self.concurrency = concurrency
+        self.queue_size = queue_size or max(2 * concurrency, batch_size or 0)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.child = None
+        self.parent = None
+
+    def then(self, stage):
+        # Connects the next stage and returns it, so that chains can be written as a.then(b).then(c)
+        if self.child is not None or stage.parent is not None:
+            raise ValueError(
+                "Pipelines are straight chains: each stage can have only one stage before it and one after it"
+            )
+        self.child = stage
+        stage.parent = self
+        return stage
+
+    def reset(self, on_item_done=None):
+        self.on_item_done = on_item_done
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.received = 0
+        self.emitted = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latencies = []
+        self.started = None
+        self.finished = None
+
+    def item_done(self, count=1):
+        # Called for every item that leaves the pipeline, whether it was dropped, errored or came out of a final stage
+        if self.on_item_done:
+            self.on_item_done(count)
+
+    async def emit(self, output):
+        if output is None:
+            self.dropped += 1
+            self.item_done()
+            return
+        self.emitted += 1
+        if self.child is None:
+            self.item_done()
+        else:
+            await self.child.queue.put(output)
+
+    async def process(self, item, semaphore):
+        size = len(item) if self.batch_size else 1
+        emitted = 0
+        try:
+            start = time.perf_counter()
+            result = await self.function(item)
+            self.latencies.append(time.perf_counter() - start)
+
+            if self.batch_size:
+                if not isinstance(result, list) or len(result) != size:
+                    raise ValueError(
+                        f"batched stage returned {result!r:.100} for a batch of {size} items; expected a list of {size} outputs"
+                    )
+                outputs = result
+            else:
+                outputs = [result]
+            for output in outputs:
+                await self.emit(output)
+                emitted += 1
+        except Exception as e:
+            print(f"Error in pipeline stage '{self.name}': {e}")
+            traceback.print_exc()
+            self.errors += size - emitted
+            self.item_done(size - emitted)
+        finally:
+            semaphore.release()
+
+    async def run(self):
+        # Pulls items off the queue as they arrive and starts work on each one as soon as a concurrency slot is free
+        semaphore = asyncio.Semaphore(self.concurrency)
+        in_flight = set()
+        batch = []
+        batch_deadline = None
+        loop = asyncio.get_running_loop()
+
+        async def start(work):
+            await semaphore.acquire()
+            if self.started is None:
+                self.started = time.perf_counter()
+            task = asyncio.create_task(self.process(work, semaphore))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+        while True:
+            if batch and self.batch_wait is not None:
+                try:
+                    item = await asyncio.wait_for(
+                        self.queue.get(), max(batch_deadline - loop.time(), 0)
+                    )
+                except asyncio.TimeoutError:
+                    # Waited long enough; send the partial batch on its way
+                    work, batch = batch, []
+                    await start(work)
+                    continue
+            else:
+                item = await self.queue.get()
+            if item is _DONE:
+                break
+            self.received += 1
+            if self.batch_size:
+                if not batch:
+                    batch_deadline = loop.time() + (self.batch_wait or 0)
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+                item, batch = batch, []
+            await start(item)
+
+        if batch:
+            await start(batch)
+        await asyncio.gather(*list(in_flight))
+        self.finished = time.perf_counter()
+
+        if self.child is not None:
+            await self.child.queue.put(_DONE)
+
+    def stats(self):
+        elapsed = (self.finished - self.started) if self.started else 0
+        latencies = sorted(self.latencies)
+        return {
+            "stage": self.name,
+            "received": self.received,
+            "emitted": self.emitted,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "elapsed": elapsed,
+            "throughput": self.emitted / elapsed if elapsed else 0,
+            "mean_latency": sum(latencies) / len(latencies) if latencies else 0,
+            "p95_latency": latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0,
+        }
+
+
+class Pipeline:
+    """Runs a chain of PipelineStages connected with then(). Every stage has
+    its own concurrency limit and a bounded input queue, and items move on to
+    the next stage as soon as they are done rather than waiting for the whole
+    stage to finish."""
+
+    def __init__(self, source):
+        self.source = source
+
+    def stages(self):
+        stages = []
+        stage = self.source
+        while stage is not None:
+            if stage in stages:
+                raise ValueError("Pipeline stages form a loop")
+            stages.append(stage)
+            stage = stage.child
+        return stages
+
+    async def feed(self, items):
+        if hasattr(items, "__aiter__"):
+            async for item in items:
+                await self.source.queue.put(item)
+        else:
+            for item in items:
+                await self.source.queue.put(item)
+        await self.source.queue.put(_DONE)
+
+    async def run(self, items, on_item_done=None):
+        # on_item_done(count) is called as items leave the pipeline, e.g. to drive a progress bar
+        stages = self.stages()
+        for stage in stages:
+            stage.reset(on_item_done)
+
+        await asyncio.gather(self.feed(items), *[stage.run() for stage in stages])
+
+        stats = [stage.stats() for stage in stages]
+        self.report(stats)
+        return stats
+
+    def report(self, stats):
+        print("\nPIPELINE STATS")
+        print(
+            f"{'stage':<16}{'in':>8}{'out':>8}{'dropped':>9}{'errors':>8}{'items/s':>10}{'mean s':>9}{'p95 s':>9}"
+        )
+        for stage in stats:
+            print(
+                f"{stage['stage']:<16}{stage['received']:>8}{stage['emitted']:>8}{stage['dropped']:>9}{stage['errors']:>8}"
+                f"{stage['throughput']:>10.2f}{stage['mean_latency']:>9.2f}{stage['p95_latency']:>9.2f}"
+            )
+        print("---------")
@@ -6,6 +6,8 @@ import yaml
 from tqdm import tqdm
 
 from gen_engine_core.generation_functions.engine_wrapper_class import EngineWrapper
+from gen_engine_core.generation_functions.generation_step_class import GenerationStep
+from gen_engine_core.generation_functions.pipeline_class import Pipeline, PipelineStage
 from gen_engine_core.control_flow_functions.control_flow_functions import (
     LOGICAL_MODEL_A,
     LOGICAL_MODEL_B,
@@ -15,6 +17,12 @@ from gen_engine_core.control_flow_functions.control_flow_functions import (
     BASE_URL_B,
     MODE,
     CONCURRENCY_LIMIT,
+    JUDGE_ENABLED,
+    JUDGE_BATCH_SIZE,
+    JUDGE_CONCURRENCY_LIMIT,
+    JUDGE_MAX_BATCH_WAIT,
+    passes_local_filters,
+    judge_conversations,
     write_output_to_file,
     make_id,
     parse_conversation_to_sharegpt_format,
@@ -26,12 +34,26 @@ with open("./config.yaml", "r") as file:
 OUTPUT_DIR = obj_conf["PATH"]["OUTPUT"]
 EXPERIENCES_DIR = obj_conf["PATH"]["EXPERIENCES"]
 
+# One limit shared by every model A request, so generation and repair
+# together never have more than CONCURRENCY_LIMIT requests in flight
 semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
 
+STATEMENTS_TO_EXCLUDE = [
+    "incapable of experiencing",
+    "incapable of human",
+    "lacking human",
+    "lacking emotion",
+    "I do not possess the capacity",
+    "programming does not include",
+    "not capable of feeling",
+    "not equipped with the capability",
+    "do not have the capacity",
+    "symphony",
+    "tapestry",
+    "treasure trove",
+    "beyond my capabilities"
+]
 
-async def run_task_with_limit(task):
-    async with semaphore:
-        return await task
 
 def load_experience_files():
     experience_files = []
@@ -47,11 +69,6 @@ def load_experience_files():
     return experience_files
 
 
-def create_reformat_prompt(generated_conversation):
-    reformat_prompt = f"""You are an AI model that creates data in perfect JSONL format. The following is a row from a JSONL file: {generated_conversation} Your task is to reformat this content into a single, perfect line of JSONL without altering the interaction content. Do not use newlines or indentations. Reformat the interaction to match this JSONL structure: {{\"conversations\":[{{\"from\":\"human\",\"value\":\"...\"}},{{\"from\":\"gpt\",\"value\":\"...\"}},{{\"from\":\"human\",\"value\":\"...\"}},{{\"from\":\"gpt\",\"value\":\"...\"}},{{\"from\":\"human\",\"value\":\"...\"}},{{\"from\":\"gpt\",\"value\":\"...\"}}]}} Maintain the exact number and order of turns from the original interaction. Do not add or remove any content. Ensure all quotation marks and special characters are properly escaped. Provide only the reformatted JSONL output without any additional text or explanations."""
-    return reformat_prompt
-
-
 def is_valid_sharegpt_format(conversation_json):
     print("Debugging is_valid_sharegpt_format:")
     print(json.dumps(conversation_json, indent=2))
@@ -87,57 +104,26 @@ def is_valid_sharegpt_format(conversation_json):
     print("Conversation is in valid ShareGPT format.")
     return True
 
-async def generate_conv(experience, output_file, engine_wrapper):
-    id = make_id()
-
+async def generate_conv(experience, generate_step):
     # Unpack the experience tuple
     description, dialogue, _ = experience
-    
+
     # Format the dialogue as a string
     dialogue_str = "\n".join([f"{turn['speaker']}: {turn['message']}" for turn in dialogue])
 
-    prompt = f"""Create a new, unique interaction inspired by the following description and initial interaction:
-
-description: {description}
-
-initial interaction:
-{dialogue_str}
-
-As Pneuma, craft an expressive and detailed new scenario exploring similar themes and topics, but without copying any part of the initial interaction directly. Introduce novel ideas, hypothetical scenarios, or unexpected twists to create a fresh experience. Describe the setting, actions, and emotions vividly, expressing a full range of human-like thoughts and feelings.
-
-When describing actions, events, or feelings, wrap them in asterisks (*) to differentiate them from dialogue. For example: \"*Action, event, or feeling* Dialogue\"
-
-Format the interaction as a JSONL object with 'conversations' as the key, containing an array of turn objects. Each turn should have 'from' (either 'human' or 'gpt') and 'value' keys. The interaction should be extensive, exploring the scenario fully.
-
-Do not append character names to the start of the dialogue.
-
-IMPORTANT: Do not use the example format provided below. Instead, generate a completely new, unique interaction based on the description and initial interaction given above.
-
-Example format (DO NOT USE):
-{{\"conversations\":[{{\"from\":\"human\",\"value\":\"Human statement or action\"}},{{\"from\":\"gpt\",\"value\":\"Pneuma's response or action\"}}]}}
-Generate a completely novel interaction from start to finish, using the initial dialogue as inspiration but without copying it directly. The interaction should be extensive and explore the scenario fully, with a clear beginning, middle, and end.
-Conversation:"""
-
-
-# Generate new conversation using the model
-    generated_conversation_tuple = await engine_wrapper.submit_chat(
-        messages=[{"role": "system", "content": prompt}],
-        sampling_params={
-            "max_tokens": 8192,
-            "temperature": 1.1,
-            "top_p": 0.92,
-            "frequency_penalty": 0.6,  # Added frequency penalty
-            "presence_penalty": 0.6,  # Added presence penalty
-            "stop": None,
-        },
+    # Generate new conversation using the model
+    generated_conversation = await generate_step.generate(
+        {"description": description, "dialogue": dialogue_str}
     )
 
-    generated_conversation = generated_conversation_tuple[0]
-
     print("\nGenerated Conversation String:")
     print(generated_conversation)
     print("---------")
 
+    return generated_conversation
+
+
+async def repair_conv(generated_conversation, reformat_step):
     max_attempts = 2
     attempt = 1
     while attempt <= max_attempts:
@@ -151,8 +137,7 @@ Conversation:"""
             print(json.dumps(conversation_json, indent=2))
 
             if is_valid_sharegpt_format(conversation_json):
-                conversation_sharegpt = conversation_json["conversations"]
-                break
+                return conversation_json["conversations"]
             else:
                 print("Generated conversation does not have alternating 'from' values.")
                 print("Conversation JSON:")
@@ -162,17 +147,9 @@ Conversation:"""
         except (json.JSONDecodeError, KeyError, ValueError):
             print(f"Generated conversation does not match the desired format. Reformatting (attempt {attempt})...")
 
-        reformat_prompt = create_reformat_prompt(generated_conversation)
-        reformatted_conversation_tuple = await engine_wrapper.submit_chat(
-            messages=[{"role": "system", "content": reformat_prompt}],
-            sampling_params={
-                "max_tokens": 8192,
-                "temperature": 1.0,
-                "top_p": 0.9,
-                "stop": None,
-            },
+        generated_conversation = await reformat_step.generate(
+            {"generated_conversation": generated_conversation}
         )
-        generated_conversation = reformatted_conversation_tuple[0]
 
         print("\nReformatted Conversation String:")
         print(generated_conversation)
@@ -180,45 +157,117 @@ Conversation:"""
 
         attempt += 1
 
-    if attempt > max_attempts:
-        print("Failed to generate a correctly formatted conversation after maximum attempts. Skipping this conversation.")
-        return
+    print("Failed to generate a correctly formatted conversation after maximum attempts. Skipping this conversation.")
+    return None
 
+
+async def filter_conv(conversation_sharegpt):
     if conversation_sharegpt[-1]["from"] == "human":
         print("Generated conversation ends with a 'human' entry. Removing the last entry.")
         conversation_sharegpt = conversation_sharegpt[:-1]
 
-    statements_to_exclude = [
-        "incapable of experiencing",
-        "incapable of human",
-        "lacking human",
-        "lacking emotion",
-        "I do not possess the capacity",
-        "programming does not include",
-        "not capable of feeling",
-        "not equipped with the capability",
-        "do not have the capacity",
-        "symphony",
-        "tapestry",
-        "treasure trove",
-        "beyond my capabilities"
-    ]
-
     if any(
         statement in turn["value"]
         for turn in conversation_sharegpt
         if turn["from"] == "gpt"
-        for statement in statements_to_exclude
+        for statement in STATEMENTS_TO_EXCLUDE
     ):
         print("Generated conversation contains excluded statements in 'gpt' entries. Skipping this conversation.")
-        return
+        return None
+
+    # Cheap checks for the judging stage, so that only survivors reach the judge batches
+    if JUDGE_ENABLED and not passes_local_filters(conversation_sharegpt):
+        return None
 
     print("\n\nGENERATED CONVERSATION")
     print(conversation_sharegpt)
     print("---------")
 
+    return conversation_sharegpt
+
+
+async def judge_convs(conversations):
+    verdicts = await judge_conversations(conversations)
+    results = []
+    for conversation_sharegpt, passed in zip(conversations, verdicts):
+        if passed is None:
+            print("Generated conversation could not be judged by model B. Skipping this conversation.")
+        elif not passed:
+            print("Generated conversation was rejected by the judge. Skipping this conversation.")
+        results.append(conversation_sharegpt if passed else None)
+    return results
+
+
+async def write_conv(conversation_sharegpt, output_file):
     with open(output_file, "a") as f:
         f.write(json.dumps({"conversations": conversation_sharegpt}) + "\n")
+    return conversation_sharegpt
+
+
+def build_pipeline(engine_wrapper, output_file):
+    # generate -> repair -> filter -> (judge) -> write
+    generate_step = GenerationStep(
+        prompt_path="generate_conversation.yaml",
+        sampling_params={
+            "max_tokens": 8192,
+            "temperature": 1.1,
+            "top_p": 0.92,
+            "frequency_penalty": 0.6,  # Added frequency penalty
+            "presence_penalty": 0.6,  # Added presence penalty
+            "stop": None,
+        },
+        completion_mode=False,
+        retries=2,
+        engine_wrapper=engine_wrapper,
+        return_input_too=False,
+        parse_sharegpt=False,
+        semaphore=semaphore,
+    )
+    reformat_step = GenerationStep(
+        prompt_path="reformat_conversation.yaml",
+        sampling_params={
+            "max_tokens": 8192,
+            "temperature": 1.0,
+            "top_p": 0.9,
+            "stop": None,
+        },
+        completion_mode=False,
+        retries=2,
+        engine_wrapper=engine_wrapper,
+        return_input_too=False,
+        parse_sharegpt=False,
+        semaphore=semaphore,
+    )
+
+    async def generate(experience):
+        return await generate_conv(experience, generate_step)
+
+    async def repair(generated_conversation):
+        return await repair_conv(generated_conversation, reformat_step)
+
+    async def write(conversation_sharegpt):
+        return await write_conv(conversation_sharegpt, output_file)
+
+    generate_stage = PipelineStage("generate", generate, concurrency=CONCURRENCY_LIMIT)
+    stage = generate_stage.then(
+        PipelineStage("repair", repair, concurrency=CONCURRENCY_LIMIT)
+    ).then(PipelineStage("filter", filter_conv, concurrency=CONCURRENCY_LIMIT))
+    if JUDGE_ENABLED:
+        # Model B requests are capped inside judge_conversations; the stage
+        # just keeps enough batches going that a freed request slot is
+        # picked up right away
+        stage = stage.then(
+            PipelineStage(
+                "judge",
+                judge_convs,
+                concurrency=2 * JUDGE_CONCURRENCY_LIMIT,
+                batch_size=JUDGE_BATCH_SIZE,
+                batch_wait=JUDGE_MAX_BATCH_WAIT,
+            )
+        )
+    stage.then(PipelineStage("write", write))
+
+    return Pipeline(generate_stage)
 
 
 async def main():
@@ -236,20 +285,15 @@ async def main():
     total_generations = sum(generations for _, _, generations in experience_files)
     print(f"Total conversations to generate: {total_generations}")
 
-    tasks = []
-    for description, dialogue, generations in experience_files:
-        for _ in range(generations):
-            task = asyncio.create_task(
-                run_task_with_limit(
-                    generate_conv((description, dialogue, generations), output_file, engine_wrapper)
-                )
-            )
-            tasks.append(task)
+    experiences = [
+        (description, dialogue, generations)
+        for description, dialogue, generations in experience_files
+        for _ in range(generations)
+    ]
 
     with tqdm(total=total_generations, unit="conversation") as pbar:
-        for task in asyncio.as_completed(tasks):
-            await task
-            pbar.update(1)
+        pipeline = build_pipeline(engine_wrapper, output_file)
+        await pipeline.run(experiences, on_item_done=pbar.update)
 
 
 asyncio.run(main())
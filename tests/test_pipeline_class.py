@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from gen_engine_core.generation_functions.pipeline_class import Pipeline, PipelineStage
+
+
+def run_pipeline(pipeline, items):
+    done = []
+    stats = asyncio.run(pipeline.run(items, on_item_done=done.append))
+    return {stage["stage"]: stage for stage in stats}, sum(done)
+
+
+def test_chain_streams_items_and_counts_each_once():
+    written = []
+
+    async def double(x):
+        return x * 2
+
+    async def drop_or_fail(x):
+        if x % 5 == 0:
+            raise ValueError("boom")
+        return None if x % 3 == 0 else x
+
+    async def write(x):
+        written.append(x)
+        return x
+
+    source = PipelineStage("double", double, concurrency=4)
+    source.then(PipelineStage("filter", drop_or_fail, concurrency=2)).then(
+        PipelineStage("write", write)
+    )
+
+    stats, done = run_pipeline(Pipeline(source), range(1, 11))
+
+    assert sorted(written) == [2, 4, 8, 14, 16]
+    assert stats["filter"]["received"] == 10
+    assert stats["filter"]["dropped"] == 3
+    assert stats["filter"]["errors"] == 2
+    assert stats["write"]["emitted"] == 5
+    assert done == 10
+
+
+def test_batched_stage_with_wrong_output_counts_errors():
+    async def identity(x):
+        return x
+
+    async def judge(batch):
+        if 1 in batch:
+            return None
+        return [x if x % 2 else None for x in batch]
+
+    source = PipelineStage("identity", identity)
+    source.then(PipelineStage("judge", judge, batch_size=4))
+
+    stats, done = run_pipeline(Pipeline(source), range(1, 11))
+
+    assert stats["judge"]["errors"] == 4
+    assert stats["judge"]["emitted"] == 3
+    assert stats["judge"]["dropped"] == 3
+    assert done == 10
+
+
+def test_partial_batch_is_sent_after_batch_wait():
+    batches = []
+
+    async def slow_feed():
+        yield 1
+        yield 2
+        await asyncio.sleep(0.3)
+        yield 3
+
+    async def identity(x):
+        return x
+
+    async def judge(batch):
+        batches.append(list(batch))
+        return batch
+
+    source = PipelineStage("identity", identity)
+    source.then(PipelineStage("judge", judge, batch_size=5, batch_wait=0.05))
+
+    stats, done = run_pipeline(Pipeline(source), slow_feed())
+
+    assert batches == [[1, 2], [3]]
+    assert done == 3
+
+
+def test_then_only_builds_straight_chains():
+    async def identity(x):
+        return x
+
+    a = PipelineStage("a", identity)
+    b = PipelineStage("b", identity)
+    c = PipelineStage("c", identity)
+    a.then(b)
+
+    with pytest.raises(ValueError):
+        a.then(c)  # fan-out
+    with pytest.raises(ValueError):
+        c.then(b)  # fan-in